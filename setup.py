@@ -40,6 +40,9 @@ setup(
         'tqdm',
         'toml',
     ],
+    extras_require={
+        'fast': ['orjson; python_version >= "3.6"'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
@@ -30,6 +30,18 @@ try:
 except:
     from pip._internal import main as pip_main
 
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the standard library
+    from time import time as monotonic
+
+try:
+    # Optional, faster JSON parser (pip install shub[fast])
+    import orjson as _fast_json
+except ImportError:
+    _fast_json = json
+
 from scrapinghub import ScrapinghubClient, ScrapinghubAPIError, HubstorageClient
 
 import shub
@@ -48,6 +60,9 @@ LAST_N_LOGS = 30
 # 50MB for a whole request, reserve 5KB for meta info (e.g. headers)
 REQUEST_FILES_SIZE_LIMIT = 50 * 1024 * 1024 - 5 * 1024
 
+_VERSION_INVALID_CHARS_RE = re.compile(r'[^\w.-]+')
+_JOB_URL_RE = re.compile(r'^https?://[^/]+/p/(\d+)/(?:job/)?(\d+/\d+)')
+
 _SETUP_PY_TEMPLATE = """\
 # Automatically created by: shub deploy
 
@@ -167,11 +182,16 @@ def echo_short_log_if_deployed(deployed, last_logs, log_file, verbose):
 
 def _is_deploy_successful(last_logs):
     try:
-        data = json.loads(to_native_str(last_logs[-1]))
+        last_log = to_native_str(last_logs[-1]).lstrip()
+        # Most log lines are plain text, don't bother parsing them as JSON
+        if not last_log.startswith('{') or '"status"' not in last_log:
+            return False
+        data = _fast_json.loads(last_log)
         if 'status' in data and data['status'] == 'ok':
             return True
     except Exception:
         pass
+    return False
 
 
 @contextlib.contextmanager
@@ -237,18 +257,26 @@ def pwd_version():
     Try to find version information on whatever lives in the current directory
     -- most commonly a Python package or Scrapy project -- by trying (in this
     order):
-        - git commit/branch
-        - mercurial commit/branch
-        - bazaar commit/branch
+        - commit/branch of the closest git, mercurial or bazaar repository,
+          then of enclosing repositories of the other VCS
         - setup.py in this folder
         - setup.py next to closest scrapy.cfg
     If none of these work, fall back to the UNIX time.
     """
-    ver = pwd_git_version()
-    if not ver:
-        ver = pwd_hg_version()
-    if not ver:
-        ver = pwd_bzr_version()
+    ver = None
+    vcs_versions = {
+        '.git': pwd_git_version,
+        '.hg': pwd_hg_version,
+        '.bzr': pwd_bzr_version,
+    }
+    # Only shell out to VCS clients whose metadata directory is present, and
+    # fall back to enclosing repositories of other VCS if one fails
+    for vcs_dir in _iter_vcs_dirs():
+        vcs_version = vcs_versions.pop(os.path.basename(vcs_dir), None)
+        if vcs_version:
+            ver = vcs_version()
+            if ver:
+                break
     if not ver and os.path.isfile('setup.py'):
         ver = _last_line_of(run_python(['setup.py', '--version']))
     if not ver:
@@ -260,10 +288,28 @@ def pwd_version():
                 ver = _last_line_of(run_python([setuppy, '--version']))
     if not ver:
         ver = str(int(time.time()))
-    ver = re.sub(r'[^\w.-]+', '', ver)
+    ver = _VERSION_INVALID_CHARS_RE.sub('', ver)
     return ver
 
 
+def _iter_vcs_dirs(start='.'):
+    """
+    Yield the paths to all git, mercurial and bazaar metadata directories in
+    ``start`` and its parents, closest first.
+    """
+    path = os.path.abspath(start)
+    while True:
+        for name in ('.git', '.hg', '.bzr'):
+            vcs_dir = os.path.join(path, name)
+            # .git is a plain file in submodules and worktrees
+            if os.path.exists(vcs_dir):
+                yield vcs_dir
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+
+
 def pwd_git_version():
     git = find_executable('git')
     if not git:
@@ -402,6 +448,15 @@ def _get_egg_info(name):
     return egg_filename, egg_path
 
 
+def _is_ascii_number(s):
+    # str.isdigit() also accepts e.g. superscripts on Python 3
+    return bool(s) and all('0' <= c <= '9' for c in s)
+
+
+def _is_identifier(s):
+    return bool(s) and all(c.isalnum() or c == '_' for c in s)
+
+
 def get_job_specs(job):
     """
     Parse job identifier into valid job id and corresponding API key.
@@ -413,11 +468,18 @@ def get_job_specs(job):
 
     It also accepts job URLs from Scrapinghub.
     """
-    match = re.match(r'^((\w+)/)?(\d+/\d+)$', job)
-    if not match:
-        job_url_re = r'^https?://[^/]+/p/((\d+)/)(?:job/)?(\d+/\d+).*'
-        match = re.match(job_url_re, job)
-    if not match:
+    target = None
+    parts = job.split('/')
+    if (len(parts) in (2, 3) and _is_ascii_number(parts[-2]) and
+            _is_ascii_number(parts[-1]) and
+            (len(parts) == 2 or _is_identifier(parts[0]))):
+        target = parts[0] if len(parts) == 3 else 'default'
+        spider_job = '/'.join(parts[-2:])
+    else:
+        match = _JOB_URL_RE.match(job)
+        if match:
+            target, spider_job = match.group(1), match.group(2)
+    if not target:
         raise BadParameterException(
             "Job ID {} is invalid. Format should be spiderid/jobid (inside a "
             "project) or target/spiderid/jobid, where target can be either a "
@@ -427,8 +489,8 @@ def get_job_specs(job):
         )
     # XXX: Lazy import due to circular dependency
     from shub.config import get_target_conf
-    targetconf = get_target_conf(match.group(2) or 'default')
-    return ("{}/{}".format(targetconf.project_id, match.group(3)),
+    targetconf = get_target_conf(target)
+    return ("{}/{}".format(targetconf.project_id, spider_job),
             targetconf.apikey)
 
 
@@ -518,15 +580,19 @@ def get_scrapycfg_targets(cfgfiles=None):
 def job_live(job, refresh_meta_after=60):
     """
     Check whether job is in 'pending' or 'running' state. If job metadata was
-    fetched longer than `refresh_meta_after` seconds ago, refresh it.
+    fetched longer than `refresh_meta_after` seconds ago, refresh it. Pass
+    ``None`` to never refresh it.
     """
-    if not hasattr(job, '_metadata_updated'):
-        # Assume just loaded
-        job._metadata_updated = time.time()
-    if time.time() - job._metadata_updated > refresh_meta_after:
-        job.metadata.expire()
-        # Fetching actually happens on job.metadata['state'], but close enough
-        job._metadata_updated = time.time()
+    if refresh_meta_after is not None:
+        now = monotonic()
+        if not hasattr(job, '_metadata_updated'):
+            # Assume just loaded
+            job._metadata_updated = now
+        elif now - job._metadata_updated > refresh_meta_after:
+            job.metadata.expire()
+            # Fetching actually happens on job.metadata['state'], but close
+            # enough
+            job._metadata_updated = now
     return job.metadata['state'] in ('pending', 'running')
 
 
@@ -567,28 +633,60 @@ def job_resource_iter(job, resource, output_json=False, follow=True,
         time.sleep(15)
 
 
+# In-process copies of successfully read or written release cache files, keyed
+# by their absolute path
+_release_cache = {}
+# Cached release data is also considered current for this many seconds after
+# it was fetched, even if it was fetched on an earlier day
+RELEASE_CACHE_TTL = 6 * 60 * 60
+
+
+def _is_release_data_current(release_data, today):
+    # Check for equality (and not smaller or equal) so we don't get thrown
+    # off track if the clock was ever misconfigured and a future date was
+    # saved
+    if release_data.get('_shub_last_update', 0) == today:
+        return True
+    age = time.time() - release_data.get('_shub_updated_at', 0)
+    return 0 <= age < RELEASE_CACHE_TTL
+
+
 def latest_github_release(force_update=False, timeout=1., cache=None):
     """
-    Get GitHub data for latest shub release. If it was already requested today,
-    return a cached version unless ``force_update`` is set to ``True``.
+    Get GitHub data for latest shub release. If it was already requested today
+    or within the last ``RELEASE_CACHE_TTL`` seconds, return a cached version
+    unless ``force_update`` is set to ``True``. Cached versions that are out of
+    date are revalidated through their ETag.
     """
     REQ_URL = "https://api.github.com/repos/scrapinghub/shub/releases/latest"
-    cache = cache or os.path.join(click.get_app_dir('scrapinghub'),
-                                  'last_release.txt')
+    cache = os.path.abspath(
+        cache or os.path.join(click.get_app_dir('scrapinghub'),
+                              'last_release.txt'))
     today = datetime.date.today().toordinal()
-    if not force_update and os.path.isfile(cache):
+    release_data = _release_cache.get(cache, {})
+    if not force_update and _is_release_data_current(release_data, today):
+        return release_data
+    # Read the cache file even when forced to update, it holds the ETag
+    if not release_data and os.path.isfile(cache):
         with open(cache, 'r') as f:
             try:
                 release_data = json.load(f)
             except Exception:
                 release_data = {}
-        # Check for equality (and not smaller or equal) so we don't get thrown
-        # off track if the clock was ever misconfigured and a future date was
-        # saved
-        if release_data.get('_shub_last_update', 0) == today:
+        if not force_update and _is_release_data_current(release_data, today):
+            _release_cache[cache] = release_data
             return release_data
-    release_data = requests.get(REQ_URL, timeout=timeout).json()
+    etag = release_data.get('_shub_etag')
+    headers = {'If-None-Match': etag} if etag else {}
+    rsp = requests.get(REQ_URL, headers=headers, timeout=timeout)
+    if not (etag and rsp.status_code == 304):
+        release_data = rsp.json()
+        # Don't keep ETags of error responses
+        etag = rsp.headers.get('ETag') if rsp.status_code == 200 else None
+        if etag:
+            release_data['_shub_etag'] = etag
     release_data['_shub_last_update'] = today
+    release_data['_shub_updated_at'] = time.time()
     try:
         shubdir = os.path.dirname(cache)
         try:
@@ -598,11 +696,24 @@ def latest_github_release(force_update=False, timeout=1., cache=None):
                 raise
         with open(cache, 'w') as f:
             json.dump(release_data, f)
+        _release_cache[cache] = release_data
     except Exception:
         pass
     return release_data
 
 
+# Parsed versions of the shub release in use, keyed by version string
+_used_versions = {}
+
+
+def _parse_used_version(version):
+    try:
+        return _used_versions[version]
+    except KeyError:
+        used_version = _used_versions[version] = StrictVersion(version)
+        return used_version
+
+
 def update_available(silent_fail=True):
     """
     Check whether most recent GitHub release of shub is newer than the shub
@@ -612,7 +723,7 @@ def update_available(silent_fail=True):
     try:
         release_data = latest_github_release()
         latest_rls = StrictVersion(release_data['name'].lstrip('v'))
-        used_rls = StrictVersion(shub.__version__)
+        used_rls = _parse_used_version(shub.__version__)
         if used_rls >= latest_rls:
             return None
         return release_data['html_url']
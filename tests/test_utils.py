@@ -9,7 +9,6 @@ import stat
 import sys
 import unittest
 import textwrap
-import time
 
 import click
 import yaml
@@ -18,6 +17,10 @@ from click.testing import CliRunner
 from collections import deque
 from mock import Mock, MagicMock, patch
 from scrapinghub import ScrapinghubAPIError
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from shub import utils
 from shub.config import ShubConfig
@@ -31,8 +34,9 @@ from .utils import AssertInvokeRaisesMixin, mock_conf
 
 class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
 
-    def setUp(self):
-        self.runner = CliRunner()
+    @classmethod
+    def setUpClass(cls):
+        cls.runner = CliRunner()
 
     @patch('shub.utils.sys.frozen', new=True, create=True)
     @patch('shub.utils.find_exe', return_value='/my/python')
@@ -82,13 +86,29 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
     @patch('shub.utils.pwd_bzr_version', return_value='ver_BZR')
     @patch('shub.utils.time.time', return_value=101)
     def test_pwd_version(self, mock_time, mock_bzr, mock_hg, mock_git):
-        self.assertEqual(utils.pwd_version(), 'ver_GIT')
-        mock_git.return_value = None
-        self.assertEqual(utils.pwd_version(), 'ver_HG')
-        mock_hg.return_value = None
-        self.assertEqual(utils.pwd_version(), 'ver_BZR')
-        mock_bzr.return_value = None
         with self.runner.isolated_filesystem():
+            os.mkdir('.git')
+            self.assertEqual(utils.pwd_version(), 'ver_GIT')
+            os.rmdir('.git')
+            os.mkdir('.hg')
+            self.assertEqual(utils.pwd_version(), 'ver_HG')
+            os.rmdir('.hg')
+            os.mkdir('.bzr')
+            self.assertEqual(utils.pwd_version(), 'ver_BZR')
+            # Fall back to enclosing repositories of other VCS
+            os.makedirs('subrepo/.git')
+            os.chdir('subrepo')
+            mock_git.return_value = None
+            self.assertEqual(utils.pwd_version(), 'ver_BZR')
+            os.chdir('..')
+            os.rmdir('subrepo/.git')
+            os.rmdir('subrepo')
+            mock_bzr.return_value = None
+            self.assertEqual(utils.pwd_version(), '101')
+            os.rmdir('.bzr')
+            self.assertEqual(mock_git.call_count, 2)
+            self.assertEqual(mock_hg.call_count, 1)
+            self.assertEqual(mock_bzr.call_count, 3)
             with open('setup.py', 'w') as f:
                 f.write("from setuptools import setup\n")
                 f.write("setup(version='1.0')")
@@ -107,16 +127,48 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             open('../scrapy.cfg', 'w').close()
             self.assertEqual(utils.pwd_version(), '1.0')
 
+    @patch('shub.utils.pwd_git_version')
+    @patch('shub.utils.pwd_hg_version')
+    @patch('shub.utils.pwd_bzr_version')
+    @patch('shub.utils.time.time', return_value=101)
+    def test_pwd_version_skips_vcs_without_metadata_dir(
+            self, mock_time, mock_bzr, mock_hg, mock_git):
+        with self.runner.isolated_filesystem():
+            self.assertEqual(utils.pwd_version(), '101')
+        self.assertFalse(mock_git.called)
+        self.assertFalse(mock_hg.called)
+        self.assertFalse(mock_bzr.called)
+
+    def test_iter_vcs_dirs(self):
+        # OSX: tempfile.mkdtemp() returns a path below the /var/ symlink while
+        # os.getcwd() resolves it to /private/var/, so compare real paths
+        def iter_vcs_dirs():
+            return [os.path.realpath(p) for p in utils._iter_vcs_dirs('a/b')]
+
+        with self.runner.isolated_filesystem() as basepath:
+            basepath = os.path.realpath(basepath)
+            os.makedirs('a/b')
+            self.assertEqual(iter_vcs_dirs(), [])
+            os.mkdir('.hg')
+            self.assertEqual(iter_vcs_dirs(), [os.path.join(basepath, '.hg')])
+            os.mkdir('a/.git')
+            self.assertEqual(iter_vcs_dirs(), [
+                os.path.join(basepath, 'a', '.git'),
+                os.path.join(basepath, '.hg'),
+            ])
+
     @patch('shub.utils.pwd_git_version')
     def test_pwd_version_clean(self, mock_git):
-        mock_git.return_value = 'vers_1'
-        self.assertEqual(utils.pwd_version(), 'vers_1')
-        mock_git.return_value = 've  rs _ 2'
-        self.assertEqual(utils.pwd_version(), 'vers_2')
-        mock_git.return_value = 'vers -3_1:1'
-        self.assertEqual(utils.pwd_version(), 'vers-3_11')
-        mock_git.return_value = 'vers -4_1!$@%#&$()2'
-        self.assertEqual(utils.pwd_version(), 'vers-4_12')
+        with self.runner.isolated_filesystem():
+            os.mkdir('.git')
+            mock_git.return_value = 'vers_1'
+            self.assertEqual(utils.pwd_version(), 'vers_1')
+            mock_git.return_value = 've  rs _ 2'
+            self.assertEqual(utils.pwd_version(), 'vers_2')
+            mock_git.return_value = 'vers -3_1:1'
+            self.assertEqual(utils.pwd_version(), 'vers-3_11')
+            mock_git.return_value = 'vers -4_1!$@%#&$()2'
+            self.assertEqual(utils.pwd_version(), 'vers-4_12')
 
     def test_get_job_specs(self):
         conf = mock_conf(self)
@@ -141,9 +193,13 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             '7389/259/1',
             'default',
         )
+        with patch('shub.utils._JOB_URL_RE') as mock_url_re:
+            _test_specs('prod/2/3', '2/2/3', 'default')
+            self.assertFalse(mock_url_re.match.called)
 
     def test_get_job_specs_validates_jobid(self):
-        invalid_job_ids = ['/1/1', '123', '1/2/a', '1//']
+        invalid_job_ids = ['/1/1', '123', '1/2/a', '1//', '1/2/3/4', 'a-b/1/2',
+                           u'1/\xb2']
         for job_id in invalid_job_ids:
             with self.assertRaises(BadParameterException):
                 utils.get_job_specs(job_id)
@@ -190,10 +246,28 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
         last_logs.append('{"status":"ok", "project": 1111112, '
                          '"version": "1234-master", "spiders": 3}')
         assert utils._is_deploy_successful(last_logs)
+        # raw lines as returned by requests
+        last_logs.append(b'  {"status": "ok"}')
+        assert utils._is_deploy_successful(last_logs)
+        # only the last line counts
+        last_logs.append(b'abcdef')
+        assert not utils._is_deploy_successful(last_logs)
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    @patch('shub.utils._fast_json', new=orjson)
+    def test_is_deploy_successful_with_orjson(self):
+        last_logs = deque(maxlen=5)
+        for line in ('{"status":"error"}', b'{"status":"error"}',
+                     '{"status":"ok"', b'{"status":"ok"'):
+            last_logs.append(line)
+            assert not utils._is_deploy_successful(last_logs)
+        for line in ('{"status":"ok"}', b'{"field":"value","status":"ok"}'):
+            last_logs.append(line)
+            assert utils._is_deploy_successful(last_logs)
 
     def test_job_live(self):
         job = MagicMock()
-        job._metadata_updated = time.time()
+        job._metadata_updated = utils.monotonic()
         for live_value in ('pending', 'running'):
             job.metadata.__getitem__.return_value = live_value
             self.assertTrue(utils.job_live(job))
@@ -202,11 +276,17 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             self.assertFalse(utils.job_live(job))
 
     def test_job_live_updates_metadata(self):
-        job = MagicMock(spec=['metadata'])
-        with patch('shub.utils.time.time') as mock_time:
-            mock_time.return_value = 0
+        class MockMetadata(dict):
+            expire = Mock()
+
+        class MockJob(object):
+            metadata = MockMetadata(state='running')
+
+        job = MockJob()
+        with patch('shub.utils.monotonic') as mock_monotonic:
+            mock_monotonic.return_value = 0
             utils.job_live(job)
-            mock_time.return_value = 10
+            mock_monotonic.return_value = 10
             utils.job_live(job, refresh_meta_after=20)
             self.assertFalse(job.metadata.expire.called)
             utils.job_live(job, refresh_meta_after=5)
@@ -214,12 +294,20 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             job.metadata.expire.reset_mock()
             utils.job_live(job, refresh_meta_after=5)
             self.assertFalse(job.metadata.expire.called)
+            mock_monotonic.reset_mock()
+            mock_monotonic.return_value = 100
+            utils.job_live(job, refresh_meta_after=None)
+            self.assertFalse(job.metadata.expire.called)
+            self.assertFalse(mock_monotonic.called)
 
     @patch('shub.utils.time.sleep')
     def test_job_resource_iter(self, mock_sleep):
-        job = MagicMock(spec=['key', 'metadata', 'resource'])
-        job.key = 'jobkey'
-        job.metadata = {'state': 'running'}
+        class MockJob(object):
+            key = 'jobkey'
+            metadata = {'state': 'running'}
+            resource = MagicMock(spec=['iter_json', 'stats'])
+
+        job = MockJob()
 
         def make_items(iterable):
             return [json.dumps({'_key': x}) for x in iterable]
@@ -270,8 +358,9 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
         job.resource.stats.return_value = {'totals': {'input_values': 1000}}
         self.assertEqual(jri_result(True, tail=3), [])
 
+    @patch('shub.utils._release_cache', new_callable=dict)
     @patch('shub.utils.requests.get', autospec=True)
-    def test_latest_github_release(self, mock_get):
+    def test_latest_github_release(self, mock_get, mock_release_cache):
         with self.runner.isolated_filesystem():
             mock_get.return_value.json.return_value = {'key': 'value'}
             self.assertDictContainsSubset(
@@ -292,6 +381,8 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             mock_get.return_value.json.return_value = {'key': 'value'}
             with open('./cache.txt', 'w') as f:
                 f.write('abc')
+            # Simulate a fresh process which has not seen the cache file yet
+            mock_release_cache.clear()
             self.assertDictContainsSubset(
                 {'key': 'value'},
                 utils.latest_github_release(cache='./cache.txt'),
@@ -306,6 +397,7 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             with open('./cache.txt', 'w') as f:
                 f.write('abc')
             os.chmod('./cache.txt', stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            mock_release_cache.clear()
             self.assertDictContainsSubset(
                 {'key': 'value'},
                 utils.latest_github_release(cache='./cache.txt'),
@@ -318,6 +410,88 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             with open('./cache.txt', 'r') as f:
                 self.assertEqual(f.read(), 'abc')
 
+    @patch('shub.utils._release_cache', new_callable=dict)
+    @patch('shub.utils.requests.get', autospec=True)
+    def test_latest_github_release_revalidates_etag(self, mock_get,
+                                                   mock_release_cache):
+        with self.runner.isolated_filesystem():
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.headers = {'ETag': '"abc"'}
+            mock_get.return_value.json.return_value = {'key': 'value'}
+            utils.latest_github_release(cache='./cache.txt')
+            self.assertEqual(mock_get.call_args[1]['headers'], {})
+            # Make sure the ETag is also picked up from the cache file
+            mock_release_cache.clear()
+            mock_get.return_value.json.reset_mock()
+            mock_get.return_value.status_code = 304
+            self.assertDictContainsSubset(
+                {'key': 'value'},
+                utils.latest_github_release(force_update=True,
+                                            cache='./cache.txt'),
+            )
+            self.assertEqual(mock_get.call_args[1]['headers'],
+                             {'If-None-Match': '"abc"'})
+            self.assertFalse(mock_get.return_value.json.called)
+            # ETag has changed
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.headers = {'ETag': '"def"'}
+            mock_get.return_value.json.return_value = {'key': 'newvalue'}
+            self.assertDictContainsSubset(
+                {'key': 'newvalue', '_shub_etag': '"def"'},
+                utils.latest_github_release(force_update=True,
+                                            cache='./cache.txt'),
+            )
+
+    @patch('shub.utils._release_cache', new_callable=dict)
+    @patch('shub.utils.requests.get', autospec=True)
+    def test_latest_github_release_ttl(self, mock_get, mock_release_cache):
+        def _write_cache(age):
+            with open('./cache.txt', 'w') as f:
+                json.dump({
+                    'key': 'value',
+                    '_shub_last_update': 0,
+                    '_shub_updated_at': 1000000 - age,
+                }, f)
+            mock_release_cache.clear()
+
+        with self.runner.isolated_filesystem(), \
+                patch('shub.utils.time.time', return_value=1000000):
+            mock_get.return_value.json.return_value = {'key': 'newvalue'}
+            # Fetched on an earlier day, but recently
+            _write_cache(utils.RELEASE_CACHE_TTL - 1)
+            self.assertDictContainsSubset(
+                {'key': 'value'},
+                utils.latest_github_release(cache='./cache.txt'),
+            )
+            self.assertFalse(mock_get.called)
+            _write_cache(utils.RELEASE_CACHE_TTL + 1)
+            self.assertDictContainsSubset(
+                {'key': 'newvalue'},
+                utils.latest_github_release(cache='./cache.txt'),
+            )
+            # Fetch time in the future
+            _write_cache(-1)
+            self.assertDictContainsSubset(
+                {'key': 'newvalue'},
+                utils.latest_github_release(cache='./cache.txt'),
+            )
+            self.assertEqual(mock_get.call_count, 2)
+
+    @patch('shub.utils._release_cache', new_callable=dict)
+    @patch('shub.utils.requests.get', autospec=True)
+    def test_latest_github_release_memoizes_cache_file(self, mock_get,
+                                                      mock_release_cache):
+        with self.runner.isolated_filesystem():
+            mock_get.return_value.json.return_value = {'key': 'value'}
+            utils.latest_github_release(cache='./cache.txt')
+            with patch('shub.utils.open', create=True,
+                       side_effect=AssertionError):
+                self.assertDictContainsSubset(
+                    {'key': 'value'},
+                    utils.latest_github_release(cache='./cache.txt'),
+                )
+            self.assertEqual(mock_get.call_count, 1)
+
     @patch('shub.utils.latest_github_release', autospec=True)
     @patch('shub.utils.shub.__version__', new='1.5.0')
     def test_update_available(self, mock_lgr):
@@ -342,6 +516,18 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
         with self.assertRaises(MockException):
             utils.update_available(silent_fail=False)
 
+    @patch('shub.utils._used_versions', new_callable=dict)
+    @patch('shub.utils.StrictVersion', wraps=utils.StrictVersion)
+    @patch('shub.utils.latest_github_release', autospec=True)
+    @patch('shub.utils.shub.__version__', new='1.5.0')
+    def test_update_available_parses_used_version_once(
+            self, mock_lgr, mock_strict_version, mock_used_versions):
+        mock_lgr.return_value = {'name': 'v1.5.1', 'html_url': 'link'}
+        self.assertEqual(utils.update_available(), 'link')
+        self.assertEqual(utils.update_available(), 'link')
+        parsed = [c[0][0] for c in mock_strict_version.call_args_list]
+        self.assertEqual(parsed, ['1.5.1', '1.5.0', '1.5.1'])
+
     @patch('shub.utils.pip_main', autospec=True)
     @patch('shub.utils.pip', autospec=True)
     def test_download_from_pypi(self, mock_pip, mock_pip_main):
@@ -427,8 +613,7 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             'a': {'unrelated': 'dict'},
             'b': {'key1': 'newval1', 'key2': 'val2', 'key3': 'val3'}
         }
-        runner = CliRunner()
-        with runner.isolated_filesystem():
+        with self.runner.isolated_filesystem():
             with open('conf.yml', 'w') as f:
                 f.write(YAML_BEFORE)
             with utils.update_yaml_dict('conf.yml') as conf:
@@ -440,7 +625,7 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
                 self.assertIn("key1: newval1", f.read())
 
     def test_update_yaml_dict_handles_file_errors(self):
-        with CliRunner().isolated_filesystem():
+        with self.runner.isolated_filesystem():
             self.assertFalse(os.path.isfile('didnt_exist.yml'))
             with utils.update_yaml_dict('didnt_exist.yml') as conf:
                 pass
@@ -458,9 +643,8 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
             with utils.update_yaml_dict():
                 pass
 
-        runner = CliRunner()
-        with runner.isolated_filesystem():
-            result = runner.invoke(call_update_yaml_dict)
+        with self.runner.isolated_filesystem():
+            result = self.runner.invoke(call_update_yaml_dict)
         assert 'deprecated' in result.output
 
     @patch('shub.utils.ScrapinghubClient')
@@ -485,7 +669,7 @@ class UtilsTest(AssertInvokeRaisesMixin, unittest.TestCase):
                 project_dir = project_dir[8:]
             return project_dir
 
-        with CliRunner().isolated_filesystem() as basepath:
+        with self.runner.isolated_filesystem() as basepath:
             os.makedirs('a/b/c')
             os.chdir('a/b/c')
             with self.assertRaises(NotFoundException):